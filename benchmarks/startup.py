@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Measure planb-pvesync CLI startup time.
+
+Usage: python3 benchmarks/startup.py [RUNS]
+
+Reports the best/median wall time of a few cheap invocations (that should
+not load proxmoxer) and the slowest imports of each, as reported by
+python -X importtime.
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = (
+    ('--help', ['-m', 'planb_pvesync', '--help']),
+    ('bad config', ['-m', 'planb_pvesync', '-f', os.devnull,
+                    '-p', 'MYCLUSTER', 'list-pve-hosts']),
+    ('import cli', ['-c', 'import planb_pvesync.cli']),
+)
+
+
+def run(args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    t0 = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + args, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+def slowest_imports(args, count=5):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imports = []
+    for line in proc.stderr.decode('utf-8', 'replace').split('\n'):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[12:].split('|')
+        imports.append((int(cumulative_us), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    baseline = [run(['-c', 'pass']) for _ in range(runs)]
+    print('{:12s} best {:6.1f} ms  median {:6.1f} ms'.format(
+        'python', min(baseline) * 1000, statistics.median(baseline) * 1000))
+    for title, args in SCENARIOS:
+        timings = [run(args) for _ in range(runs)]
+        print('{:12s} best {:6.1f} ms  median {:6.1f} ms'.format(
+            title, min(timings) * 1000, statistics.median(timings) * 1000))
+        for cumulative_us, name in slowest_imports(args):
+            print('    {:8.1f} ms  {}'.format(cumulative_us / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Block device diffs in the "rbd diff v1" format of rbd export-diff.
+
+Used to sync non-ZFS volumes (Ceph RBD, LVM-thin) into a local zvol:
+
+    blockdiff.py apply DEVICE [--digests] # stdin: diff stream
+    blockdiff.py hash DEVICE CHUNK        # stdout: chunk digests
+    blockdiff.py diff DEVICE CHUNK NAME   # stdin: digests, stdout: diff
+
+'apply' writes a stream (from rbd export-diff or from 'diff') to DEVICE.
+'hash' and 'diff' do changed-block detection for sources without native
+diffs: the digests of the current destination go to the source host,
+which only sends the chunks that differ. After the end record, 'diff'
+appends the digests of all source chunks; 'apply --digests' copies those
+to stdout, so the next run need not 'hash' the destination.
+
+It runs as a script on the backup host, and through remotepy.py on the
+storage host.
+"""
+from hashlib import blake2b
+import os
+import struct
+import sys
+
+RBD_DIFF_HEADER = b'rbd diff v1\n'
+DIGEST_SIZE = 16
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+U64U64 = struct.Struct('<QQ')
+
+
+class BlockDiffError(Exception):
+    pass
+
+
+def read_exact(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise BlockDiffError('short read ({} of {} bytes)'.format(
+            len(data), size))
+    return data
+
+
+def chunk_digest(data):
+    return blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def apply(device, infp, bufsize=(4 << 20), digests_outfp=None):
+    """
+    Apply an rbd diff v1 stream to device. Returns the 't' (to snapshot)
+    name, if any. With digests_outfp, the digests trailing a 'diff'
+    stream are written to it once the device is synced.
+    """
+    if read_exact(infp, len(RBD_DIFF_HEADER)) != RBD_DIFF_HEADER:
+        raise BlockDiffError('not an rbd diff v1 stream')
+    to_snap = None
+    zeroes = bytes(bufsize)
+    fd = os.open(device, os.O_WRONLY)
+    try:
+        device_size = os.lseek(fd, 0, os.SEEK_END)
+        while True:
+            tag = read_exact(infp, 1)
+            if tag in (b'f', b't'):
+                length, = U32.unpack(read_exact(infp, U32.size))
+                name = read_exact(infp, length).decode('utf-8')
+                if tag == b't':
+                    to_snap = name
+            elif tag == b's':
+                size, = U64.unpack(read_exact(infp, U64.size))
+                if size > device_size:
+                    raise BlockDiffError(
+                        'image size {} exceeds device size {}'.format(
+                            size, device_size))
+            elif tag in (b'w', b'z'):
+                offset, length = U64U64.unpack(read_exact(infp, U64U64.size))
+                os.lseek(fd, offset, os.SEEK_SET)
+                while length:
+                    todo = min(length, bufsize)
+                    if tag == b'w':
+                        data = read_exact(infp, todo)
+                    else:
+                        data = zeroes[:todo]
+                    os.write(fd, data)  # block devices: no short writes
+                    length -= todo
+            elif tag == b'e':
+                break
+            else:
+                raise BlockDiffError('unknown record {!r}'.format(tag))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if digests_outfp:
+        write_digest_list(read_digests(infp), digests_outfp)
+    return to_snap
+
+
+def iter_chunks(device, chunk_size):
+    with open(device, 'rb', buffering=0) as fp:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+def write_digests(device, chunk_size, outfp):
+    digests = [chunk_digest(i) for i in iter_chunks(device, chunk_size)]
+    write_digest_list(digests, outfp)
+
+
+def write_digest_list(digests, outfp):
+    outfp.write(U64.pack(len(digests)))
+    outfp.write(b''.join(digests))
+    outfp.flush()
+
+
+def read_digests(infp):
+    count, = U64.unpack(read_exact(infp, U64.size))
+    data = read_exact(infp, count * DIGEST_SIZE)
+    return [
+        data[i:(i + DIGEST_SIZE)]
+        for i in range(0, len(data), DIGEST_SIZE)]
+
+
+def write_diff(device, chunk_size, to_snap, digests, outfp):
+    """
+    Write the chunks of device that differ from the destination digests
+    as an rbd diff v1 stream. Zero chunks become 'z' records, or nothing
+    at all beyond the end of the (sparse) destination. The digests of
+    all chunks follow the end record.
+    """
+    name = to_snap.encode('utf-8')
+    with open(device, 'rb') as fp:
+        size = fp.seek(0, os.SEEK_END)
+    outfp.write(RBD_DIFF_HEADER)
+    outfp.write(b't' + U32.pack(len(name)) + name)
+    outfp.write(b's' + U64.pack(size))
+
+    zero_digest = None
+    offset = 0
+    new_digests = []
+    for index, data in enumerate(iter_chunks(device, chunk_size)):
+        digest = chunk_digest(data)
+        new_digests.append(digest)
+        if index >= len(digests) or digest != digests[index]:
+            if zero_digest is None or len(data) != chunk_size:
+                zero_digest = chunk_digest(bytes(len(data)))
+            if digest == zero_digest:
+                if index < len(digests):
+                    outfp.write(b'z' + U64U64.pack(offset, len(data)))
+            else:
+                outfp.write(b'w' + U64U64.pack(offset, len(data)))
+                outfp.write(data)
+        offset += len(data)
+    outfp.write(b'e')
+    write_digest_list(new_digests, outfp)
+
+
+def main(argv, infp, outfp):
+    if len(argv) == 2 and argv[0] == 'apply':
+        apply(argv[1], infp)
+    elif len(argv) == 3 and argv[0] == 'apply' and argv[2] == '--digests':
+        apply(argv[1], infp, digests_outfp=outfp)
+    elif len(argv) == 3 and argv[0] == 'hash':
+        write_digests(argv[1], int(argv[2]), outfp)
+    elif len(argv) == 4 and argv[0] == 'diff':
+        write_diff(argv[1], int(argv[2]), argv[3], read_digests(infp), outfp)
+    else:
+        raise BlockDiffError('usage: see {}'.format(__doc__))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:], sys.stdin.buffer, sys.stdout.buffer)
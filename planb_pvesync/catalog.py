@@ -0,0 +1,169 @@
+from datetime import datetime
+from os import path
+import sqlite3
+import time
+
+from .output import RECORD_WRITERS
+
+
+class BackupCatalog:
+    """
+    Local SQLite index of the snapshots received below --sync-zfs-root,
+    so restores and audits need not run zfs list over the whole tree.
+
+    Example usage:
+
+      catalog = BackupCatalog('~/.planb-pvesync.sqlite3')
+      catalog.update_dataset(
+          cluster='acme_cluster', guest='acme-web', vmid=152,
+          filestore='local-ssd', volume='vm-152-disk-1',
+          dataset='tank/enc/acme-web/local-ssd--vm-152-disk-1',
+          snapshots=lfs.get_snapshot_properties(*SNAPSHOT_PROPERTIES))
+      for row in catalog.find(guest='acme-web'):
+          print(row['dataset'], row['snapshot'])
+
+    """
+    SNAPSHOT_PROPERTIES = ('guid', 'used', 'referenced', 'creation')
+
+    FIELDS = (
+        'cluster', 'guest', 'vmid', 'filestore', 'volume', 'dataset',
+        'snapshot', 'guid', 'used', 'referenced', 'created', 'received')
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS snapshots (
+            cluster TEXT NOT NULL,
+            guest TEXT NOT NULL,
+            vmid INTEGER NOT NULL,
+            filestore TEXT NOT NULL,
+            volume TEXT NOT NULL,
+            dataset TEXT NOT NULL,
+            snapshot TEXT NOT NULL,
+            guid TEXT NOT NULL,         -- unsigned 64 bits; too large for INT
+            used INTEGER,
+            referenced INTEGER,
+            created INTEGER NOT NULL,   -- unixtime, snapshot creation
+            received INTEGER NOT NULL,  -- unixtime, first seen locally
+            PRIMARY KEY (dataset, snapshot));
+        CREATE INDEX IF NOT EXISTS snapshots_guest
+            ON snapshots (guest, volume, created);
+        CREATE INDEX IF NOT EXISTS snapshots_vmid
+            ON snapshots (vmid, volume, created);
+    '''
+
+    def __init__(self, filename):
+        self._filename = path.expanduser(filename)  # ~ => $HOME
+        self._db = sqlite3.connect(self._filename)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript(self.SCHEMA)
+
+    def update_dataset(
+            self, *, cluster, guest, vmid, filestore, volume, dataset,
+            snapshots):
+        """
+        Make the rows for dataset match snapshots, a list of
+        (snapshot_name, {'guid': ..., 'used': ..., 'referenced': ...,
+        'creation': ...}) tuples. Removed snapshots are dropped;
+        known snapshots keep their received time.
+        """
+        now = int(time.time())
+        with self._db:
+            received = dict(self._db.execute(
+                'SELECT snapshot, received FROM snapshots WHERE dataset = ?',
+                (dataset,)).fetchall())
+            self._db.execute(
+                'DELETE FROM snapshots WHERE dataset = ?', (dataset,))
+            self._db.executemany(
+                'INSERT INTO snapshots ({}) VALUES ({})'.format(
+                    ', '.join(self.FIELDS), ', '.join('?' * len(self.FIELDS))),
+                [(cluster, guest, vmid, filestore, volume, dataset,
+                  snapshot, props['guid'], int(props['used']),
+                  int(props['referenced']), int(props['creation']),
+                  received.get(snapshot, now))
+                 for snapshot, props in snapshots])
+
+    def find(self, *, cluster=None, guest=None, volume=None, before=None):
+        """
+        Yield matching snapshot rows, newest first. guest is a name or a
+        VMID (int); before is a unixtime.
+        """
+        where, args = [], []
+        if cluster is not None:
+            where.append('cluster = ?')
+            args.append(cluster)
+        if isinstance(guest, int):
+            where.append('vmid = ?')
+            args.append(guest)
+        elif guest is not None:
+            where.append('guest = ?')
+            args.append(guest)
+        if volume is not None:
+            where.append('volume = ?')
+            args.append(volume)
+        if before is not None:
+            where.append('created <= ?')
+            args.append(before)
+
+        query = 'SELECT {} FROM snapshots'.format(', '.join(self.FIELDS))
+        if where:
+            query += ' WHERE {}'.format(' AND '.join(where))
+        query += ' ORDER BY created DESC, dataset'
+        for row in self._db.execute(query, args):
+            yield dict(row)
+
+
+class CatalogCommand:
+    def __init__(self, *, catalog, cluster_name=None, guest_name=None,
+                 volume_name=None, output_format='text'):
+        self._catalog = BackupCatalog(catalog)
+        self._cluster_name = cluster_name
+
+        if guest_name and guest_name.isdigit():
+            guest_name = int(guest_name)  # name or vmid?
+        self._guest_name = guest_name
+        self._volume_name = volume_name
+
+        if output_format == 'text':
+            self._writer = None
+        else:
+            self._writer = RECORD_WRITERS[output_format](BackupCatalog.FIELDS)
+
+    def write(self, row):
+        if self._writer:
+            self._writer.write(row)
+        else:
+            # acme_cluster/152/acme-web/local-ssd/vm-152-disk-1@daily-...
+            print(
+                '{r[cluster]}/{r[vmid]}/{r[guest]}/{r[filestore]}/'
+                '{r[volume]}@{r[snapshot]} ({created}; {r[referenced]} bytes)'
+                ' {r[dataset]}'.format(
+                    r=row, created=datetime.fromtimestamp(
+                        row['created']).strftime('%Y-%m-%d %H:%M')))
+
+
+class ListBackups(CatalogCommand):
+    def run(self):
+        for row in self._catalog.find(
+                cluster=self._cluster_name, guest=self._guest_name,
+                volume=self._volume_name):
+            self.write(row)
+
+
+class FindBackup(CatalogCommand):
+    """
+    Find the newest snapshot per volume of a guest, taken at or before
+    the 'before' unixtime (default: now).
+    """
+    def __init__(self, *, before=None, **kwargs):
+        super().__init__(**kwargs)
+        self._before = before
+
+    def run(self):
+        seen = set()
+        for row in self._catalog.find(
+                cluster=self._cluster_name, guest=self._guest_name,
+                volume=self._volume_name, before=self._before):
+            if row['dataset'] not in seen:
+                seen.add(row['dataset'])
+                self.write(row)
+        return (0 if seen else 1)
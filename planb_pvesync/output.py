@@ -0,0 +1,54 @@
+import csv
+import json
+import sys
+
+
+class JsonLinesWriter:
+    """
+    Write one JSON object per line, flushed as soon as it is written.
+    """
+    def __init__(self, fields, fp=None):
+        self._fp = fp or sys.stdout
+
+    def write(self, record):
+        self._fp.write(json.dumps(record))
+        self._fp.write('\n')
+        self._fp.flush()
+
+
+class CsvWriter:
+    """
+    Write CSV rows with a fixed header, flushed as soon as they are written.
+
+    Lists are joined by spaces and dicts are written as PVE style
+    key=value,key=value options.
+    """
+    def __init__(self, fields, fp=None):
+        self._fp = fp or sys.stdout
+        self._writer = csv.DictWriter(
+            self._fp, fieldnames=fields, restval='', extrasaction='ignore')
+        self._writer.writeheader()
+
+    def write(self, record):
+        self._writer.writerow(dict(
+            (key, self._flatten(value)) for key, value in record.items()))
+        self._fp.flush()
+
+    @staticmethod
+    def _flatten(value):
+        if value is None:
+            return ''
+        if isinstance(value, dict):
+            return ','.join(
+                (key if subvalue is None else '{}={}'.format(key, subvalue))
+                for key, subvalue in value.items())
+        if isinstance(value, (list, tuple)):
+            return ' '.join(str(i) for i in value)
+        return value
+
+
+# The 'text' format is not listed here: it prints the (sorted) object reprs.
+RECORD_WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+}
@@ -1,15 +1,34 @@
 import logging
 
-from proxmoxer import ProxmoxAPI
-
 log = logging.getLogger(__name__)
 
+SIZE_SUFFIXES = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """
+    Convert PVE disk size '50G' (or '4096', '512M', '1.5G') to bytes.
+    Returns None if the value cannot be parsed.
+    """
+    suffix = value[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        value, multiplier = value[:-1], SIZE_SUFFIXES[suffix]
+    else:
+        multiplier = 1
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        return None
+
 
 class PveCluster:
     """
     Wrapper around ProxmoxAPI.
     """
     def __init__(self, config):
+        # Imported here, because proxmoxer (and requests) are slow to load.
+        from proxmoxer import ProxmoxAPI
+
         self._config = config
         self._name = config.host
         self._api = ProxmoxAPI(
@@ -85,6 +104,21 @@ class PveHost:
         self.cluster = cluster
         self.type = type
         self.name = node
+        self.status = kwargs.get('status')
+        self.maxcpu = kwargs.get('maxcpu')
+        self.maxmem = kwargs.get('maxmem')
+        self.maxdisk = kwargs.get('maxdisk')
+        self.mem = kwargs.get('mem')
+        self.disk = kwargs.get('disk')
+        self.uptime = kwargs.get('uptime')
+
+    def as_dict(self):
+        return {
+            'cluster': self.cluster.name, 'type': self.type,
+            'name': self.name, 'status': self.status,
+            'maxcpu': self.maxcpu, 'maxmem': self.maxmem,
+            'maxdisk': self.maxdisk, 'mem': self.mem, 'disk': self.disk,
+            'uptime': self.uptime}
 
     def __repr__(self):
         """
@@ -107,12 +141,30 @@ class PveFilestore:
         self.is_enabled = (not int(kwargs.pop('disable', 0)))
         self.path_or_pool = (
             kwargs.pop('path', None), kwargs.pop('pool', None))
+        self.content = kwargs.pop('content', None)
+        self.nodes = kwargs.pop('nodes', None)
+        self.is_sparse = bool(int(kwargs.pop('sparse', 0)))
+        self.is_shared = bool(int(kwargs.pop('shared', 0)))
+        kwargs.pop('digest', None)
+        self.options = kwargs  # remaining type-specific storage options
         self.remote_access = None
 
     def set_remote_access(self, access):
         assert not self.remote_access
         self.remote_access = access
 
+    def as_dict(self):
+        return {
+            'cluster': self.cluster.name, 'type': self.type,
+            'name': self.name, 'is_enabled': self.is_enabled,
+            'path': self.path_or_pool[0], 'pool': self.path_or_pool[1],
+            'content': self.content, 'nodes': self.nodes,
+            'is_sparse': self.is_sparse, 'is_shared': self.is_shared,
+            'options': self.options,
+            'remote_access': (
+                self.remote_access.run_remote_args
+                if self.remote_access else None)}
+
     def __repr__(self):
         return (
             '{cluster.name}/{o.type}/{o.name}'
@@ -140,6 +192,11 @@ class PveGuest:
         self.name = name
         self.vmid = vmid
         self.node = node
+        self.pool = kwargs.get('pool')
+        self.maxcpu = kwargs.get('maxcpu')
+        self.maxmem = kwargs.get('maxmem')
+        self.maxdisk = kwargs.get('maxdisk')
+        self.is_template = bool(kwargs.get('template', 0))
         if status == 'running':
             self.is_running = True
             self.is_stopped = False
@@ -154,6 +211,14 @@ class PveGuest:
             return (self.vmid == name_or_vmid)
         return (self.name == name_or_vmid)
 
+    def as_dict(self):
+        return {
+            'cluster': self.cluster.name, 'type': self.type,
+            'vmid': self.vmid, 'name': self.name, 'node': self.node,
+            'is_running': self.is_running, 'pool': self.pool,
+            'maxcpu': self.maxcpu, 'maxmem': self.maxmem,
+            'maxdisk': self.maxdisk, 'is_template': self.is_template}
+
     def enum_guestvolumes(self):
         """
         {'memory': 4096, 'arch': 'amd64',
@@ -220,7 +285,7 @@ class PveGuestVolume:
         if ',' in info:
             storage, info = info.split(',', 1)
         else:
-            storage, info = storage, ''
+            storage, info = info, ''
         if ':' in storage:
             storage, volume = storage.split(':', 1)
         else:
@@ -230,7 +295,13 @@ class PveGuestVolume:
 
         self.name = volume
         self.info = info
-        self.is_removable = ('media=cdrom' in info.split(','))
+        self.options = dict(
+            (i.split('=', 1) if '=' in i else (i, None))
+            for i in info.split(',') if i)
+        self.size = (
+            parse_size(self.options['size'])
+            if self.options.get('size') else None)
+        self.is_removable = (self.options.get('media') == 'cdrom')
 
         if self.is_removable:
             self.filestore = self.cluster.get_filestore(None)
@@ -239,6 +310,19 @@ class PveGuestVolume:
             self.filestore = self.cluster.get_filestore(storage)
             self.is_enabled = self.filestore.is_enabled
 
+    def as_dict(self):
+        return {
+            'cluster': self.cluster.name, 'vmid': self.guest.vmid,
+            'guest': self.guest.name, 'driver': self.driver,
+            'filestore': self.filestore.name,
+            'filestore_type': self.filestore.type, 'name': self.name,
+            'size': self.size, 'is_boot': self.is_boot,
+            'is_enabled': self.is_enabled,
+            'is_removable': self.is_removable, 'options': self.options,
+            'remote_access': (
+                self.filestore.remote_access.run_remote_args
+                if self.filestore.remote_access else None)}
+
     def __repr__(self):
         """
         MYCLUSTER/zfspool/mc15-1-pve-local-ssd/vm-152-disk-1(vm=152;BOOT)
@@ -1,3 +1,4 @@
+from .output import RECORD_WRITERS
 from .pveapi import PveCluster
 
 
@@ -10,36 +11,99 @@ class Command:
         self._guest_name = guest_name
 
 
-class ListHosts(Command):
+class ListCommand(Command):
+    """
+    List command that prints sorted object reprs (output_format='text')
+    or streams unsorted records, as they are fetched, through one of the
+    RECORD_WRITERS.
+    """
+    fields = ()
+
+    def __init__(self, *, output_format='text', **kwargs):
+        super().__init__(**kwargs)
+        if output_format == 'text':
+            self._writer = None
+        else:
+            self._writer = RECORD_WRITERS[output_format](self.fields)
+
     def run(self):
+        if self._writer:
+            self.run_records()
+        else:
+            self.run_text()
+
+
+class ListHosts(ListCommand):
+    fields = (
+        'cluster', 'type', 'name', 'status', 'maxcpu', 'maxmem', 'maxdisk',
+        'mem', 'disk', 'uptime')
+
+    def run_text(self):
         for host in sorted(self._cluster.enum_hosts(), key=(
                 lambda x: x.name)):
             print(host)
 
+    def run_records(self):
+        for host in self._cluster.enum_hosts():
+            self._writer.write(host.as_dict())
 
-class ListGuests(Command):
-    def run(self):
-        for guest in sorted(self._cluster.enum_guests(), key=(
+
+class ListGuests(ListCommand):
+    # Guest records and guestvolume records are written to the same stream;
+    # 'record' tells them apart.
+    fields = (
+        'record', 'cluster', 'type', 'vmid', 'guest', 'name', 'node',
+        'is_running', 'pool', 'maxcpu', 'maxmem', 'maxdisk', 'is_template',
+        'driver', 'filestore', 'filestore_type', 'size', 'is_boot',
+        'is_enabled', 'is_removable', 'options', 'remote_access')
+
+    def run_text(self):
+        for guest in sorted(self.enum_guests(), key=(
                 lambda x: (x.is_running, x.type, x.name))):
+            print(guest)
+            for guestvolume in sorted(self.enum_guestvolumes(guest), key=(
+                    lambda x: (
+                        x.is_enabled, not x.is_boot, x.filestore.name,
+                        x.name))):
+                print(' ', guestvolume, guestvolume.filestore.remote_access)
+
+    def run_records(self):
+        for guest in self.enum_guests():
+            self._writer.write(dict(record='guest', **guest.as_dict()))
+            for guestvolume in self.enum_guestvolumes(guest):
+                self._writer.write(
+                    dict(record='guestvolume', **guestvolume.as_dict()))
+
+    def enum_guests(self):
+        for guest in self._cluster.enum_guests():
             if self._guest_name:
                 if not guest.match(self._guest_name):
                     continue
             elif not guest.is_running:
                 continue
+            yield guest
 
-            print(guest)
-            for guestvolume in sorted(guest.enum_guestvolumes(), key=(
-                    lambda x: (
-                        x.is_enabled, not x.is_boot, x.filestore.name,
-                        x.name))):
-                if guestvolume.is_enabled and not guestvolume.is_removable:
-                    print(
-                        ' ', guestvolume, guestvolume.filestore.remote_access)
+    def enum_guestvolumes(self, guest):
+        for guestvolume in guest.enum_guestvolumes():
+            if guestvolume.is_enabled and not guestvolume.is_removable:
+                yield guestvolume
 
 
-class ListFilestores(Command):
-    def run(self):
-        for filestore in sorted(self._cluster.enum_filestores(), key=(
+class ListFilestores(ListCommand):
+    fields = (
+        'cluster', 'type', 'name', 'is_enabled', 'path', 'pool', 'content',
+        'nodes', 'is_sparse', 'is_shared', 'options', 'remote_access')
+
+    def run_text(self):
+        for filestore in sorted(self.enum_filestores(), key=(
                 lambda x: (x.is_enabled, x.type, x.name))):
+            print(filestore, filestore.remote_access)
+
+    def run_records(self):
+        for filestore in self.enum_filestores():
+            self._writer.write(filestore.as_dict())
+
+    def enum_filestores(self):
+        for filestore in self._cluster.enum_filestores():
             if filestore.is_enabled:
-                print(filestore, filestore.remote_access)
+                yield filestore
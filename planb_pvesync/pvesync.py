@@ -1,11 +1,24 @@
+import logging
+from os import path
+import re
+
+from .catalog import BackupCatalog
+from .config import DIGEST_CACHE, DigestCache
 from .pvecommand import Command
-from .synccommand import SyncFilesystem
+from .retry import call_with_retry
+from .synccommand import SyncFilesystem, SyncVolume
+from .transport import (
+    get_free_port, get_ssh_peer_address, raw_tcp_recv_pipe,
+    raw_tcp_send_pipe)
+from .volume import LvmThinVolume, RbdVolume
 from .zfs import LocalFilesystem, RemoteFilesystem
 
+log = logging.getLogger(__name__)
+
 
-def guestvolume_to_localfs(guestvolume, *, zfs_root):
+def guestvolume_to_localfs(guestvolume, *, zfs_root, **kwargs):
     fs = (
-        LocalFilesystem(zfs_root=zfs_root)
+        LocalFilesystem(zfs_root=zfs_root, **kwargs)
         # .descend(guestvolume.guest.cluster.name)
         .descend(guestvolume.guest.name)
         .descend('{}--{}'.format(
@@ -13,31 +26,102 @@ def guestvolume_to_localfs(guestvolume, *, zfs_root):
     return fs
 
 
-def guestvolume_to_remotefs(guestvolume, *, zfs_root, run_remote_args):
+def guestvolume_to_remotefs(
+        guestvolume, *, zfs_root, run_remote_args, **kwargs):
     fs = (
-        RemoteFilesystem(zfs_root=zfs_root, run_remote_args=run_remote_args)
+        RemoteFilesystem(
+            zfs_root=zfs_root, run_remote_args=run_remote_args, **kwargs)
         .descend(guestvolume.name))
     return fs
 
 
-class SyncGuestVolumes(Command):
-    def __init__(self, *, config, guest_name, local_zfs_root):
-        super().__init__(config=config, guest_name=guest_name)
-        self._local_zfs_root = local_zfs_root
+def parse_monhost(monhost):
+    """
+    Return the PVE monhost (separated by spaces, commas or semicolons)
+    as a --mon-host value, or None.
+    """
+    if not monhost:
+        return None
+    return ','.join(i for i in re.split(r'[ ,;]+', monhost) if i)
+
+
+def guestvolume_to_sourcevolume(guestvolume, *, run_remote_args, **kwargs):
+    filestore = guestvolume.filestore
+    if filestore.type == 'rbd':
+        options = filestore.options
+        keyring = options.get('keyring')
+        if options.get('monhost') and not keyring:
+            # Where PVE keeps the keyring of an external cluster.
+            keyring = '/etc/pve/priv/ceph/{}.keyring'.format(filestore.name)
+        return RbdVolume(
+            run_remote_args=run_remote_args,
+            pool=(filestore.path_or_pool[1] or 'rbd'), image=guestvolume.name,
+            mon_host=parse_monhost(options.get('monhost')),
+            user=options.get('username'), keyring=keyring,
+            namespace=options.get('namespace'))
+    if filestore.type == 'lvmthin':
+        return LvmThinVolume(
+            run_remote_args=run_remote_args,
+            vgname=filestore.options['vgname'], lvname=guestvolume.name,
+            **kwargs)
+    raise ValueError(
+        'storage type {!r} of {!r} is not supported'.format(
+            filestore.type, filestore))
+
+
+def update_catalog(catalog, guestvolume, localfs, *, cluster_name):
+    catalog.update_dataset(
+        cluster=cluster_name, guest=guestvolume.guest.name,
+        vmid=guestvolume.guest.vmid, filestore=guestvolume.filestore.name,
+        volume=guestvolume.name, dataset=localfs.name,
+        snapshots=localfs.get_snapshot_properties(
+            *BackupCatalog.SNAPSHOT_PROPERTIES))
+
+
+def guestvolume_to_seedfile(guestvolume, *, seed_dir):
+    # Same naming as the local filesystem, flattened into one directory.
+    return path.join(seed_dir, '{}--{}--{}.zfs'.format(
+        guestvolume.guest.name, guestvolume.filestore.name,
+        guestvolume.name))
+
+
+class _GuestVolumesCommand(Command):
+    _catalog = None
 
     def run(self):
+        for guestvolume in self.enum_guestvolumes():
+            self.run_volume(guestvolume)
+
+    def enum_guestvolumes(self):
         guest = self._cluster.get_guest(self._guest_name)
         for guestvolume in sorted(guest.enum_guestvolumes(), key=(
                 lambda x: (
                     x.is_enabled, not x.is_boot, x.filestore.name,
                     x.name))):
             if guestvolume.is_enabled and not guestvolume.is_removable:
-                self.run_volume(guestvolume)
+                yield guestvolume
 
     def run_volume(self, guestvolume):
-        lfs = guestvolume_to_localfs(
-            guestvolume, zfs_root=self._local_zfs_root)
+        raise NotImplementedError()
+
+    def update_catalog(self, guestvolume, localfs):
+        """
+        Record the local snapshots, if there is a catalog. The volume is
+        synced already, so failing to do so is only logged.
+        """
+        if not self._catalog:
+            return True
+        try:
+            update_catalog(
+                self._catalog, guestvolume, localfs,
+                cluster_name=self._cluster_name)
+        except Exception as e:
+            log.error('%s: catalog update failed: %s', guestvolume, e)
+            log.debug('%s: catalog update failed', guestvolume, exc_info=True)
+            return False
+        return True
 
+    def get_remote_access(self, guestvolume):
         raccess = guestvolume.filestore.remote_access
         if not raccess:
             raise ValueError(
@@ -47,9 +131,132 @@ class SyncGuestVolumes(Command):
                 '(probably) missing [storage:{}:{}] in config'.format(
                     guestvolume.guest.cluster.name,
                     guestvolume.filestore.name))
-        rfs = guestvolume_to_remotefs(
+        return raccess
+
+    def get_remotefs(self, guestvolume, **kwargs):
+        raccess = self.get_remote_access(guestvolume)
+        if guestvolume.filestore.type != 'zfspool':
+            raise ValueError(
+                'only zfspool storage supported here, not {!r}'.format(
+                    guestvolume.filestore))
+        return guestvolume_to_remotefs(
             guestvolume, zfs_root=guestvolume.filestore.path_or_pool[1],
-            run_remote_args=raccess.run_remote_args)
+            run_remote_args=raccess.run_remote_args,
+            agent_command=raccess.agent_command, **kwargs)
 
-        syncer = SyncFilesystem(srcfs=rfs, dstfs=lfs)
+
+class SyncGuestVolumes(_GuestVolumesCommand):
+    """
+    Sync all guest volumes. A failing volume does not stop the others;
+    transient failures are retried (and resumed) first. Returns exit
+    status 1 if any volume failed.
+    """
+    def __init__(self, *, config, guest_name, local_zfs_root, retries=3,
+                 catalog=None):
+        super().__init__(config=config, guest_name=guest_name)
+        self._cluster_name = config.cluster_name
+        self._local_zfs_root = local_zfs_root
+        self._retries = retries
+        self._catalog = BackupCatalog(catalog) if catalog else None
+
+    def run(self):
+        results = []
+        for guestvolume in self.enum_guestvolumes():
+            try:
+                attempts = call_with_retry(
+                    (lambda: self.run_volume(guestvolume)),
+                    what=guestvolume, retries=self._retries)
+            except Exception as e:
+                log.error('%s: sync failed: %s', guestvolume, e)
+                log.debug('%s: sync failed', guestvolume, exc_info=True)
+                results.append((guestvolume, 'FAILED', str(e)))
+            else:
+                info = '{} attempt(s)'.format(attempts)
+                # Outside the retry: a catalog problem is no reason to
+                # sync the volume again.
+                lfs = guestvolume_to_localfs(
+                    guestvolume, zfs_root=self._local_zfs_root)
+                if not self.update_catalog(guestvolume, lfs):
+                    info += ', catalog not updated'
+                results.append((guestvolume, 'OK', info))
+
+        self.print_summary(results)
+        return (1 if any(i[1] != 'OK' for i in results) else 0)
+
+    def print_summary(self, results):
+        failed = len([i for i in results if i[1] != 'OK'])
+        print('SUMMARY: {} ok, {} failed'.format(
+            len(results) - failed, failed))
+        for guestvolume, status, info in results:
+            print('  {:6s}  {}  {}'.format(status, guestvolume, info))
+
+    def run_volume(self, guestvolume):
+        raccess = self.get_remote_access(guestvolume)
+        if guestvolume.filestore.type == 'zfspool':
+            # Use the configured/benchmarked compression for the transfer.
+            # (Seed files always use the default, so they stay portable.)
+            deflate_bin, inflate_bin = raccess.deflate_bin, raccess.inflate_bin
+            raw_tcp = (raccess.transport == 'raw-tcp')
+            if raw_tcp:
+                peer = get_ssh_peer_address(raccess.run_remote_args)
+                port = get_free_port()
+                deflate_bin = '{} | {}'.format(
+                    deflate_bin, raw_tcp_send_pipe(port))
+                inflate_bin = '{} | {}'.format(
+                    raw_tcp_recv_pipe(port, peer), inflate_bin)
+            rfs = self.get_remotefs(guestvolume, deflate_bin=deflate_bin)
+            lfs = guestvolume_to_localfs(
+                guestvolume, zfs_root=self._local_zfs_root,
+                inflate_bin=inflate_bin)
+            syncer = SyncFilesystem(srcfs=rfs, dstfs=lfs, raw_tcp=raw_tcp)
+        else:
+            # LVM-thin/RBD: diffs applied to a local zvol. (blockdiff.py
+            # always runs as 'sudo python3', whatever agent= says: it
+            # needs root to read the block devices.)
+            srcvol = guestvolume_to_sourcevolume(
+                guestvolume, run_remote_args=raccess.run_remote_args)
+            lfs = guestvolume_to_localfs(
+                guestvolume, zfs_root=self._local_zfs_root)
+            syncer = SyncVolume(
+                srcvol=srcvol, dstfs=lfs,
+                digest_cache=DigestCache(DIGEST_CACHE))
         syncer.run()
+
+
+class SeedExportGuestVolumes(_GuestVolumesCommand):
+    """
+    Write the initial full streams to seed_dir on the storage host.
+    """
+    def __init__(self, *, config, guest_name, seed_dir):
+        super().__init__(config=config, guest_name=guest_name)
+        self._seed_dir = seed_dir
+
+    def run_volume(self, guestvolume):
+        rfs = self.get_remotefs(guestvolume)
+
+        syncer = SyncFilesystem(srcfs=rfs, dstfs=None)
+        syncer.seed_export(
+            guestvolume_to_seedfile(guestvolume, seed_dir=self._seed_dir))
+
+
+class SeedImportGuestVolumes(_GuestVolumesCommand):
+    """
+    Receive the seed_dir files (moved to this host) into local_zfs_root.
+    """
+    def __init__(self, *, config, guest_name, local_zfs_root, seed_dir,
+                 catalog=None):
+        super().__init__(config=config, guest_name=guest_name)
+        self._cluster_name = config.cluster_name
+        self._local_zfs_root = local_zfs_root
+        self._seed_dir = seed_dir
+        self._catalog = BackupCatalog(catalog) if catalog else None
+
+    def run_volume(self, guestvolume):
+        lfs = guestvolume_to_localfs(
+            guestvolume, zfs_root=self._local_zfs_root)
+        rfs = self.get_remotefs(guestvolume)
+
+        syncer = SyncFilesystem(srcfs=rfs, dstfs=lfs)
+        syncer.seed_import(
+            guestvolume_to_seedfile(guestvolume, seed_dir=self._seed_dir))
+        self.update_catalog(guestvolume, lfs)
@@ -0,0 +1,29 @@
+"""
+Run a helper module (zfsagent.py, blockdiff.py) on a storage host without
+installing anything there: the remote python3 reads the source of the
+module from stdin and executes it as __main__.
+
+Such modules are executed standalone, so they must stay stdlib-only and
+free of package imports.
+"""
+from shlex import quote as shell_quote
+
+
+def module_source(module):
+    with open(module.__file__, 'rb') as fp:
+        return fp.read()
+
+
+def remote_python_arg(interpreter, source, name, *args):
+    """
+    Return a remote shell argument that makes interpreter (e.g. 'sudo
+    python3') run source, with args as sys.argv[1:]. The caller must
+    write source to its stdin first; anything after it is left for the
+    module to read.
+    """
+    bootstrap = (
+        'import sys;exec(compile(sys.stdin.buffer.read({}),'
+        '{!r},"exec"))'.format(len(source), name))
+    return ' '.join(
+        [interpreter, '-c', shell_quote(bootstrap)] +
+        [shell_quote(str(i)) for i in args])
@@ -0,0 +1,71 @@
+import logging
+import time
+from subprocess import CalledProcessError
+
+from .synccommand import SyncFilesystem, TransferInterrupted
+
+log = logging.getLogger(__name__)
+
+# ssh(1) exits with 255 if the connection failed or broke off.
+SSH_ERROR_RETURNCODE = 255
+
+# Lowercase stderr fragments of errors that may go away by themselves.
+TRANSIENT_MESSAGES = (
+    'dataset is busy',
+    'connection closed',
+    'connection refused',
+    'connection reset',
+    'connection timed out',
+    'broken pipe',
+    'no route to host',
+    'operation timed out',
+)
+
+
+def is_transient_error(exc):
+    """
+    Return True if exc is worth retrying: a dropped (ssh) connection, an
+    interrupted transfer or a busy dataset.
+    """
+    if isinstance(exc, TransferInterrupted):
+        return True
+    if isinstance(exc, CalledProcessError):
+        if exc.returncode == SSH_ERROR_RETURNCODE:
+            return True
+        # Both ZfsError and the failed send/recv pipes carry the stderr.
+        if exc.stderr:
+            stderr = exc.stderr
+            if isinstance(stderr, bytes):
+                stderr = stderr.decode('utf-8', 'replace')
+            stderr = stderr.lower()
+            # A full destination also breaks the pipe on the sending
+            # side; that is not worth another attempt.
+            if any(i in stderr for i in SyncFilesystem.RECV_FATAL_MESSAGES):
+                return False
+            return any(i in stderr for i in TRANSIENT_MESSAGES)
+    return False
+
+
+def call_with_retry(
+        fun, *, what, retries, base_delay=30, max_delay=600,
+        sleep=time.sleep):
+    """
+    Call fun() and return the attempt count. Retry transient errors up to
+    retries times, with exponential backoff from base_delay up to
+    max_delay seconds.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            fun()
+        except Exception as e:
+            if attempt > retries or not is_transient_error(e):
+                raise
+            delay = min(base_delay * 2 ** (attempt - 1), max_delay)
+            log.warning(
+                '%s: transient failure, retry %d/%d in %ds: %s',
+                what, attempt, retries, delay, e)
+            sleep(delay)
+        else:
+            return attempt
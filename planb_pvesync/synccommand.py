@@ -1,8 +1,20 @@
 from datetime import datetime
-from subprocess import check_call
+from hashlib import sha256
+import logging
+from os import path
+from shlex import quote as shell_quote
+from subprocess import (
+    CalledProcessError, PIPE, Popen, call, check_call, run)
+import sys
+from tempfile import NamedTemporaryFile
+import time
 
+from .transport import run_raw_tcp
+from .volume import blockdiff_local_args
 from .zfs import ZfsError
 
+log = logging.getLogger(__name__)
+
 
 class NoCommonSnapshots(Exception):
     def __init__(self, left, left_snaps, right, right_snaps):
@@ -21,12 +33,81 @@ class NoCommonSnapshots(Exception):
                 right_snaps='\n- '.join(sorted(self.right_snaps)))
 
 
+class TransferInterrupted(CalledProcessError):
+    """
+    The send/recv pipe failed, but the receive can be resumed.
+    """
+    pass
+
+
+class SeedChecksumError(Exception):
+    def __init__(self, filename, expected, actual):
+        self.filename = filename
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return (
+            'Seed file {filename!r} has SHA-256 {actual}, expected '
+            '{expected}; the received dataset was destroyed').format(
+                filename=self.filename, expected=self.expected,
+                actual=self.actual)
+
+
+class VerificationError(Exception):
+    def __init__(self, left, right, snapshot, left_values, right_values):
+        self.left = left
+        self.right = right
+        self.snapshot = snapshot
+        self.left_values = left_values
+        self.right_values = right_values
+
+    def __str__(self):
+        return (
+            'Snapshot {snapshot!r} differs between (src) {left!r} '
+            'and (dst) {right!r}: {left_values!r} vs {right_values!r}').format(
+                snapshot=self.snapshot, left=self.left, right=self.right,
+                left_values=self.left_values, right_values=self.right_values)
+
+
 class SyncFilesystem:
-    def __init__(self, *, srcfs, dstfs):
+    SEED_CHUNK_SIZE = 4 * 1024 * 1024
+
+    # Lowercase stderr fragments of send/recv errors that a resume will
+    # not fix, even if recv left a resume token.
+    RECV_FATAL_MESSAGES = (
+        'out of space',
+        'no space left',
+        'quota exceeded',
+        'destination has been modified',
+    )
+    # ... and those that say the source snapshot is gone: the partial
+    # receive can never complete, so it is aborted.
+    RECV_SOURCE_GONE_MESSAGES = (
+        'does not exist',
+        'no longer exists',
+    )
+
+    # Checked after every receive. The guid is kept by zfs recv, and the
+    # logical (uncompressed) referenced bytes must be the same on both
+    # sides. The source values are fetched along with the send size
+    # estimate, so this costs one extra (local) zfs get only.
+    VERIFY_PROPERTIES = ('guid', 'logicalreferenced')
+
+    def __init__(self, *, srcfs, dstfs, raw_tcp=False):
         self._srcfs = srcfs
         self._dstfs = dstfs
+        # If set, the deflate/inflate pipes of srcfs/dstfs connect through
+        # raw_tcp_send_pipe()/raw_tcp_recv_pipe() instead of stdout.
+        self._raw_tcp = raw_tcp
 
     def run(self):
+        resume_token = self._dstfs.get_receive_resume_token()
+        if resume_token:
+            # Finish the interrupted transfer first, then continue with
+            # an incremental to a fresh snapshot like any other run.
+            self.sync_resume(resume_token)
+
         try:
             newest_common, source_snaps, dest_snaps = self.get_snapshots()
         except NoCommonSnapshots as e:
@@ -45,15 +126,12 @@ class SyncFilesystem:
         self._dstfs.ensure_parent_exists()
 
         # Assemble send/recv commands
-        expected_size = self._srcfs.send_snapshot_size(snapshot)
+        expected_size, expected_values = (
+            self._srcfs.send_snapshot_size_and_values(
+                snapshot, *self.VERIFY_PROPERTIES))
         sendcmd = self._srcfs.send_snapshot_command(snapshot)
-        recvcmd = self._dstfs.recv_command(
-            pre_pipe='pv -ptebar -B512M -w72 -s{}'.format(expected_size))
-        shcmd = ['/bin/sh', '-c', '{} | {}'.format(
-            sendcmd.as_shell(), recvcmd.as_shell())]
-        print('EXEC1', shcmd)
-        check_call(shcmd)
-        # FIXME: todo: check snapshot for success..?
+        self._send_recv('EXEC1', sendcmd, expected_size)
+        self.verify_snapshot(snapshot, expected_values)
 
     def sync_increment(self, source_snapshots, prev_snapshot):
         assert source_snapshots
@@ -62,17 +140,176 @@ class SyncFilesystem:
         else:
             snapshot = self.create_source_snapshot()  # create new
 
-        expected_size = self._srcfs.send_snapshot_size(
-            snapshot, prev_snapshot_name=prev_snapshot)
+        expected_size, expected_values = (
+            self._srcfs.send_snapshot_size_and_values(
+                snapshot, *self.VERIFY_PROPERTIES,
+                prev_snapshot_name=prev_snapshot))
         sendcmd = self._srcfs.send_snapshot_command(
             snapshot, prev_snapshot_name=prev_snapshot)
+        self._send_recv('EXEC2', sendcmd, expected_size)
+        self.verify_snapshot(snapshot, expected_values)
+
+    def sync_resume(self, resume_token):
+        """
+        Continue an interrupted (initial or incremental) receive.
+        """
+        expected_size = self._srcfs.send_resume_size(resume_token)
+        sendcmd = self._srcfs.send_resume_command(resume_token)
+        self._send_recv('EXEC5', sendcmd, expected_size)
+        self.verify_snapshot(self._dstfs.get_snapshots_by_date()[-1])
+
+    def verify_snapshot(self, snapshot, expected_values=None):
+        """
+        Compare VERIFY_PROPERTIES of the received snapshot with the
+        source (expected_values, if already fetched). A mismatching
+        snapshot is discarded before raising VerificationError, so the
+        next run does not build on it.
+        """
+        if expected_values is None:
+            expected_values = self._srcfs.get_snapshot_values(
+                snapshot, *self.VERIFY_PROPERTIES)
+        values = self._dstfs.get_snapshot_values(
+            snapshot, *self.VERIFY_PROPERTIES)
+        if values != expected_values:
+            self.discard_snapshot(snapshot)
+            raise VerificationError(
+                left=self._srcfs, right=self._dstfs, snapshot=snapshot,
+                left_values=expected_values, right_values=values)
+
+    def discard_snapshot(self, snapshot):
+        """
+        Roll the destination back to the snapshot before this one, or
+        destroy it altogether if this was the first.
+        """
+        dest_snaps = self._dstfs.get_snapshots_by_date()
+        index = dest_snaps.index(snapshot)
+        if index:
+            self._dstfs.rollback_snapshot(
+                dest_snaps[index - 1], destroy_later=True)
+        else:
+            self._dstfs.destroy()
+
+    def _send_recv(self, label, sendcmd, expected_size):
         recvcmd = self._dstfs.recv_command(
             pre_pipe='pv -ptebar -B512M -w72 -s{}'.format(expected_size))
-        shcmd = ['/bin/sh', '-c', '{} | {}'.format(
-            sendcmd.as_shell(), recvcmd.as_shell())]
-        print('EXEC2', shcmd)
+        with NamedTemporaryFile(prefix='planb-pvesync-') as errfp:
+            # Collect the send and recv errors (but not the pv progress)
+            # so we can tell why the transfer failed.
+            errfile = shell_quote(errfp.name)
+            sendsh = '{{ {}; }} 2>>{}'.format(sendcmd.as_shell(), errfile)
+            recvsh = '{} 2>>{}'.format(recvcmd.as_shell(), errfile)
+            if self._raw_tcp:
+                shcmd = [sendsh, recvsh]
+                print(label, shcmd)
+                send_returncode, returncode, _ = run_raw_tcp(sendsh, recvsh)
+                returncode = returncode or send_returncode
+            else:
+                shcmd = ['/bin/sh', '-c', '{} | {}'.format(sendsh, recvsh)]
+                print(label, shcmd)
+                returncode = call(shcmd)
+            if returncode:
+                e = CalledProcessError(returncode, shcmd, stderr=errfp.read())
+                sys.stderr.write(e.stderr.decode('utf-8', 'replace'))
+                self._handle_send_recv_error(e)
+                raise e
+
+    def _handle_send_recv_error(self, e):
+        """
+        Raise TransferInterrupted if the failed transfer can be resumed.
+        """
+        # Only the exit code of the last pipe (zfs recv) is known here.
+        # If it left a resume token, the stream broke off underway; the
+        # messages tell whether that was a connection problem.
+        if not self._dstfs.get_receive_resume_token():
+            return
+        message = e.stderr.decode('utf-8', 'replace').lower()
+        if any(i in message for i in self.RECV_SOURCE_GONE_MESSAGES):
+            self._dstfs.abort_receive()
+        elif not any(i in message for i in self.RECV_FATAL_MESSAGES):
+            raise TransferInterrupted(
+                e.returncode, e.cmd, e.output, e.stderr) from e
+
+    def seed_export(self, filename):
+        """
+        Write the initial full stream to filename on the source host
+        (e.g. removable media), instead of sending it over the wire.
+
+        Only the source filesystem is used; dstfs may be None.
+        """
+        source_snapshots = self._srcfs.get_snapshots_by_date()
+        if source_snapshots:
+            snapshot = source_snapshots[-1]  # take newest
+        else:
+            snapshot = self.create_source_snapshot()  # create new
+
+        sendcmd = self._srcfs.send_snapshot_to_file_command(
+            snapshot, filename)
+        shcmd = ['/bin/sh', '-c', sendcmd.as_shell()]
+        print('EXEC3', shcmd)
         check_call(shcmd)
-        # FIXME: todo: check snapshot for success..?
+
+    def seed_import(self, filename):
+        """
+        Receive a seed_export() file into the (empty) destination,
+        checking its SHA-256 while streaming it; on a mismatch the
+        received filesystem is destroyed again. Afterwards the regular
+        run() continues with incrementals.
+        """
+        try:
+            dest_snaps = self._dstfs.get_snapshots_by_date()
+        except ZfsError:
+            dest_snaps = []  # nothing found?
+        if dest_snaps:
+            raise ValueError('{!r} already has snapshots, not seeding'.format(
+                self._dstfs))
+
+        with open('{}.sha256'.format(filename)) as fp:
+            expected = fp.read().split()[0]
+
+        self._dstfs.ensure_parent_exists()
+
+        recvcmd = self._dstfs.recv_command(
+            pre_pipe='pv -ptebar -B512M -w72 -s{}'.format(
+                path.getsize(filename)))
+        hasher = sha256()
+        with NamedTemporaryFile(prefix='planb-pvesync-') as errfp:
+            shcmd = ['/bin/sh', '-c', '{} 2>>{}'.format(
+                recvcmd.as_shell(), shell_quote(errfp.name))]
+            print('EXEC4', shcmd, '<', filename)
+            proc = Popen(shcmd, stdin=PIPE)
+            try:
+                with open(filename, 'rb') as fp:
+                    for chunk in iter(
+                            (lambda: fp.read(self.SEED_CHUNK_SIZE)), b''):
+                        hasher.update(chunk)
+                        proc.stdin.write(chunk)
+            except BrokenPipeError:
+                pass  # recv stopped early; its returncode tells us why
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                returncode = proc.wait()
+            if returncode:
+                e = CalledProcessError(returncode, shcmd, stderr=errfp.read())
+                sys.stderr.write(e.stderr.decode('utf-8', 'replace'))
+                # A seed is not resumed: drop the partial receive, so the
+                # next import (or sync) does not trip over its token.
+                if self._dstfs.get_receive_resume_token():
+                    self._dstfs.abort_receive()
+                raise e
+        if hasher.hexdigest() != expected:
+            # The checksum is only known after recv has committed it. We
+            # refused to seed into a filesystem with snapshots, so
+            # everything in there came from this file.
+            self._dstfs.destroy()
+            raise SeedChecksumError(filename, expected, hasher.hexdigest())
+
+        # Raises NoCommonSnapshots if the seeded snapshot is gone from the
+        # source: then incrementals would not work.
+        newest_common, source_snaps, dest_snaps = self.get_snapshots()
+        self.verify_snapshot(newest_common)
 
     def create_source_snapshot(self):
         now = datetime.now()
@@ -98,3 +335,128 @@ class SyncFilesystem:
         raise NoCommonSnapshots(
             left=self._srcfs, left_snaps=source_snaps,
             right=self._dstfs, right_snaps=dest_snaps)
+
+
+class SyncVolume:
+    """
+    Sync a non-ZFS source volume (see volume.py) into a local zvol, by
+    applying "rbd diff" streams to the zvol and snapshotting it after.
+    """
+    DEVICE_TIMEOUT = 30  # seconds to wait for udev to create the zvol node
+
+    def __init__(self, *, srcvol, dstfs, digest_cache=None):
+        self._srcvol = srcvol
+        self._dstfs = dstfs
+        # DigestCache, for sources that use dest digests.
+        self._digest_cache = digest_cache
+
+    def run(self):
+        try:
+            dest_snaps = self._dstfs.get_snapshots_by_date()
+        except ZfsError:
+            dest_snaps = []  # nothing found?
+
+        prev_snapshot = snapshot = None
+        if self._srcvol.keeps_snapshots:
+            source_snaps = self._srcvol.get_snapshots_by_date()
+            common_snaps = set(source_snaps) & set(dest_snaps)
+            for common_snapshot in reversed(source_snaps):
+                if common_snapshot in common_snaps:
+                    prev_snapshot = common_snapshot
+                    break
+            else:
+                if dest_snaps:
+                    raise NoCommonSnapshots(
+                        left=self._srcvol, left_snaps=source_snaps,
+                        right=self._dstfs, right_snaps=dest_snaps)
+            if source_snaps and source_snaps[-1] != prev_snapshot:
+                # Take newest, e.g. created by an earlier failed attempt.
+                snapshot = source_snaps[-1]
+            dest_base = prev_snapshot
+        else:
+            self._srcvol.remove_stale_snapshots()
+            dest_base = (dest_snaps[-1] if dest_snaps else None)
+
+        if dest_base:
+            # Undo a partially applied diff of an earlier failed run. For
+            # RBD, dest_base is the newest common snapshot: newer local
+            # ones (their source snapshot was removed) have to go too.
+            self._dstfs.rollback_snapshot(dest_base, destroy_later=True)
+
+        new_snapshot = (snapshot is None)
+        if new_snapshot:
+            snapshot = 'daily-{}'.format(
+                datetime.now().strftime('%Y%m%d%H%M'))
+        try:
+            if new_snapshot:
+                self._srcvol.make_snapshot(snapshot)
+            created = self._dstfs.ensure_volume_size(self._srcvol.get_size())
+            self.wait_for_device()
+            digests = self.transfer(
+                snapshot, prev_snapshot,
+                dest_digests=self.get_dest_digests(dest_base, created))
+        finally:
+            if not self._srcvol.keeps_snapshots:
+                self.remove_source_snapshot(snapshot)
+        self._dstfs.make_snapshot(snapshot)
+        if digests and self._digest_cache:
+            self._digest_cache.set(self._dstfs.name, snapshot, digests)
+
+    def remove_source_snapshot(self, snapshot):
+        try:
+            self._srcvol.remove_snapshot(snapshot)
+        except CalledProcessError as e:
+            # Don't hide the original error; remove_stale_snapshots()
+            # cleans up next time.
+            log.warning('%s: removing snapshot %s failed: %s',
+                        self._srcvol, snapshot, e)
+
+    def get_dest_digests(self, dest_base, created):
+        """
+        Return the digests of the (rolled back) destination, if the
+        source needs them: none for a new zvol, the cached ones if they
+        are of dest_base, or else by reading the whole zvol.
+        """
+        if not self._srcvol.uses_dest_digests or created:
+            return None
+        if dest_base and self._digest_cache:
+            digests = self._digest_cache.get(self._dstfs.name, dest_base)
+            if digests:
+                return digests
+        ret = run(
+            blockdiff_local_args(
+                'hash', self._dstfs.device_path, self._srcvol.CHUNK_SIZE),
+            stdout=PIPE, check=True)
+        return ret.stdout
+
+    def transfer(self, snapshot, prev_snapshot, dest_digests=None):
+        """
+        Apply the diff to the zvol. Returns the new source digests, if
+        the source uses dest digests.
+        """
+        if self._srcvol.uses_dest_digests:
+            applycmd = blockdiff_local_args(
+                'apply', self._dstfs.device_path, '--digests')
+        else:
+            applycmd = blockdiff_local_args('apply', self._dstfs.device_path)
+        print('EXEC6', self._srcvol, snapshot, prev_snapshot, applycmd)
+        sender = self._srcvol.export_diff(
+            snapshot, prev_snapshot_name=prev_snapshot,
+            dest_digests=dest_digests)
+        receiver = Popen(applycmd, stdin=sender.stdout, stdout=PIPE)
+        sender.stdout.close()  # receiver owns it now
+        digests = receiver.communicate()[0]
+        sender.wait()
+        if sender.returncode:
+            raise CalledProcessError(sender.returncode, sender.args)
+        if receiver.returncode:
+            raise CalledProcessError(receiver.returncode, applycmd)
+        return digests or None
+
+    def wait_for_device(self):
+        deadline = time.monotonic() + self.DEVICE_TIMEOUT
+        while not path.exists(self._dstfs.device_path):
+            if time.monotonic() > deadline:
+                raise ValueError('{} did not appear'.format(
+                    self._dstfs.device_path))
+            time.sleep(0.2)
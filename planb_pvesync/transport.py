@@ -0,0 +1,265 @@
+import logging
+import os
+from shlex import quote as shell_quote
+from shutil import which
+import signal
+import socket
+from subprocess import DEVNULL, PIPE, Popen, check_output, run
+import time
+
+from .config import COMPRESSIONS, TRANSPORT_CACHE, TransportCache
+from .pvecommand import Command
+
+log = logging.getLogger(__name__)
+
+# Candidate ciphers, in order of preference when equally fast.
+SSH_CIPHERS = (
+    'aes128-gcm@openssh.com',
+    'aes256-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com',
+    'aes128-ctr',
+)
+
+# transport=raw-tcp: the data goes through mbuffer over plain TCP, from
+# the storage host to a port on this host; ssh only starts the sender.
+RAW_TCP_MBUFFER = 'mbuffer -q -m 128M'
+RAW_TCP_LISTEN_DELAY = 0.5  # seconds for the receiving mbuffer to listen
+
+
+def get_free_port():
+    # Pick a free port (and hope it stays free).
+    sock = socket.socket()
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_ssh_peer_address(run_remote_args):
+    """
+    Return the address of the storage host on the ssh connection (the
+    server address in its $SSH_CONNECTION). The mbuffer it starts
+    connects from there, so the listener only accepts that address.
+    """
+    ret = check_output(
+        tuple(run_remote_args) + ('echo "$SSH_CONNECTION"',),
+        stdin=DEVNULL)
+    fields = ret.decode('utf-8').split()
+    if len(fields) != 4:
+        raise ValueError('{}: unexpected SSH_CONNECTION {!r}'.format(
+            ' '.join(run_remote_args), ret))
+    return fields[2]
+
+
+def raw_tcp_send_pipe(port):
+    """
+    Return the remote pipe stage sending stdin to port on the host the
+    ssh connection comes from.
+    """
+    return '{} -O "${{SSH_CLIENT%% *}}":{}'.format(RAW_TCP_MBUFFER, port)
+
+
+def raw_tcp_recv_pipe(port, peer):
+    """
+    Return the local pipe stage writing what arrives on port to stdout.
+    Only a connection from the peer address is accepted (see
+    get_ssh_peer_address()).
+    """
+    return '{} -I {}:{}'.format(RAW_TCP_MBUFFER, shell_quote(peer), port)
+
+
+def _kill_session(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass  # gone already
+
+
+def run_raw_tcp(sendcmd, recvcmd, **kwargs):
+    """
+    Run the shell commands sendcmd and recvcmd, which connect through
+    raw_tcp_send_pipe()/raw_tcp_recv_pipe() instead of a pipe. Returns
+    the (sendcmd, recvcmd) return codes, and the recvcmd stdout if
+    stdout=PIPE is passed.
+    """
+    # The receiver listens first; in its own session, so it can be
+    # killed with its mbuffer if the sender never connects. That also
+    # keeps a Ctrl-C from reaching it, so it is killed on any way out.
+    receiver = Popen(
+        ['/bin/sh', '-c', recvcmd], start_new_session=True, **kwargs)
+    try:
+        time.sleep(RAW_TCP_LISTEN_DELAY)
+        sender = run(
+            ['/bin/sh', '-c', sendcmd], stderr=kwargs.get('stderr'))
+        if sender.returncode:
+            _kill_session(receiver)
+        stdout, _ = receiver.communicate()
+    finally:
+        if receiver.poll() is None:
+            _kill_session(receiver)
+            receiver.wait()
+    return sender.returncode, receiver.returncode, stdout
+
+
+class BenchmarkTransports(Command):
+    """
+    Measure the transfer speed from every configured storage host for
+    the available ssh ciphers and compressions (and optionally raw TCP
+    through mbuffer), and store the fastest ssh transport in the
+    transport cache. Explicit cipher=/compression= config still wins.
+
+    The payload is the first bytes of a zfs send of the newest snapshot
+    on the storage pool, so compression is measured on real data.
+    """
+    MIB = 1024 * 1024
+
+    def __init__(self, *, config, guest_name=None, size=1024 * MIB,
+                 raw_tcp=False, transport_cache=TRANSPORT_CACHE):
+        super().__init__(config=config, guest_name=guest_name)
+        self._size = size
+        self._raw_tcp = raw_tcp
+        self._cache = TransportCache(transport_cache)
+
+    def run(self):
+        seen = set()
+        for filestore in self._cluster.enum_filestores():
+            raccess = filestore.remote_access
+            if (not filestore.is_enabled or not raccess or
+                    raccess.ssh in seen):
+                continue
+            seen.add(raccess.ssh)
+            self.run_host(raccess.ssh, filestore.path_or_pool[1])
+
+    def run_host(self, ssh, zfs_root):
+        payload, is_real_data = self.get_payload(ssh, zfs_root)
+        results = []
+
+        # Ciphers, without compression (warm up the source first).
+        self.measure(ssh, SSH_CIPHERS[0], 'none', payload)
+        for cipher in self.get_local_ciphers():
+            speed = self.measure(ssh, cipher, 'none', payload)
+            if speed:
+                results.append(self.report(ssh, 'ssh', cipher, 'none', speed))
+        if not results:
+            log.error('%s: no working ssh cipher found', ssh)
+            return
+        best_cipher = max(results, key=(lambda x: x['speed']))['cipher']
+
+        # Compressions, with the fastest cipher. Only meaningful when
+        # the payload is real data.
+        if is_real_data:
+            for compression in list(COMPRESSIONS.keys())[1:]:
+                if not self.has_compression(ssh, compression):
+                    continue
+                speed = self.measure(ssh, best_cipher, compression, payload)
+                if speed:
+                    results.append(self.report(
+                        ssh, 'ssh', best_cipher, compression, speed))
+
+        if self._raw_tcp:
+            speed = self.measure_raw_tcp(ssh, payload)
+            if speed:
+                results.append(
+                    self.report(ssh, 'raw-tcp', None, 'none', speed))
+
+        best = max(
+            (i for i in results if i['transport'] == 'ssh'),
+            key=(lambda x: x['speed']))
+        self._cache.set(ssh, {
+            'cipher': best['cipher'], 'compression': best['compression'],
+            'measured': int(time.time()), 'results': results})
+        print('{}: using ssh cipher {} with compression {}'.format(
+            ssh, best['cipher'], best['compression']))
+        raw = [i for i in results if i['transport'] == 'raw-tcp']
+        if raw and raw[0]['speed'] > best['speed']:
+            # Not selected automatically: raw TCP is unencrypted.
+            print('{}: raw TCP is faster ({:.1f} MiB/s), but unencrypted; '
+                  'set transport=raw-tcp to use it'.format(
+                      ssh, raw[0]['speed']))
+
+    def report(self, ssh, transport, cipher, compression, speed):
+        print('{:24s} {:8s} {:32s} {:6s} {:8.1f} MiB/s'.format(
+            ssh, transport, cipher or '-', compression, speed))
+        return {
+            'transport': transport, 'cipher': cipher,
+            'compression': compression, 'speed': round(speed, 1)}
+
+    def get_payload(self, ssh, zfs_root):
+        ret = run(
+            ['ssh', ssh, 'sudo zfs list -H -o name -t snapshot '
+             '-s creation -r {} | tail -n 1'.format(shell_quote(zfs_root))],
+            stdout=PIPE, stderr=DEVNULL)
+        snapshot = ret.stdout.decode('utf-8', 'replace').strip()
+        if ret.returncode or not snapshot:
+            log.warning(
+                '%s: no snapshot found below %s; using zeroes, skipping '
+                'the compression tests', ssh, zfs_root)
+            return ('head -c {} /dev/zero'.format(self._size), False)
+        return ('sudo zfs send {} | head -c {}'.format(
+            shell_quote(snapshot), self._size), True)
+
+    def get_local_ciphers(self):
+        ret = run(['ssh', '-Q', 'cipher'], stdout=PIPE, check=True)
+        available = ret.stdout.decode('utf-8').split()
+        return [i for i in SSH_CIPHERS if i in available]
+
+    def has_compression(self, ssh, compression):
+        deflate_bin, inflate_bin = COMPRESSIONS[compression]
+        if not which(inflate_bin.split()[0]):
+            return False
+        ret = run(
+            ['ssh', ssh, 'command -v {}'.format(deflate_bin.split()[0])],
+            stdout=DEVNULL, stderr=DEVNULL)
+        return ret.returncode == 0
+
+    def measure(self, ssh, cipher, compression, payload):
+        """
+        Return MiB/s of payload over ssh with cipher and compression, or
+        None if that failed (e.g. cipher unsupported by the remote).
+        """
+        deflate_bin, inflate_bin = COMPRESSIONS[compression]
+        # Count the bytes at the end: the exit status of the ssh in the
+        # middle of the pipe is lost.
+        shcmd = '{} | {} | wc -c'.format(
+            ' '.join(shell_quote(i) for i in (
+                'ssh', '-c', cipher, ssh,
+                '{} | {}'.format(payload, deflate_bin))),
+            inflate_bin)
+        t0 = time.monotonic()
+        ret = run(['/bin/sh', '-c', shcmd], stdout=PIPE, stderr=DEVNULL)
+        elapsed = time.monotonic() - t0
+        transferred = int(ret.stdout.strip() or 0)
+        if ret.returncode or not transferred:
+            log.info('%s: %s/%s failed', ssh, cipher, compression)
+            return None
+        return transferred / self.MIB / elapsed
+
+    def measure_raw_tcp(self, ssh, payload):
+        """
+        Return MiB/s of payload through mbuffer over plain TCP, with the
+        local end listening. None if mbuffer is missing.
+        """
+        if not which('mbuffer'):
+            log.warning('mbuffer not found locally, skipping raw TCP')
+            return None
+        ret = run(
+            ['ssh', ssh, 'command -v mbuffer'], stdout=DEVNULL,
+            stderr=DEVNULL)
+        if ret.returncode:
+            log.warning('%s: mbuffer not found, skipping raw TCP', ssh)
+            return None
+
+        peer = get_ssh_peer_address(('ssh', ssh))
+        port = get_free_port()
+        sendcmd = ' '.join(shell_quote(i) for i in (
+            'ssh', ssh, '{} | {}'.format(payload, raw_tcp_send_pipe(port))))
+        t0 = time.monotonic()
+        send_returncode, recv_returncode, stdout = run_raw_tcp(
+            sendcmd, '{} | wc -c'.format(raw_tcp_recv_pipe(port, peer)),
+            stdout=PIPE, stderr=DEVNULL)
+        elapsed = time.monotonic() - t0 - RAW_TCP_LISTEN_DELAY
+        transferred = int(stdout.strip() or 0)
+        if send_returncode or recv_returncode or not transferred:
+            log.warning('%s: raw TCP through mbuffer failed', ssh)
+            return None
+        return transferred / self.MIB / elapsed
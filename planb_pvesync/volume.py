@@ -0,0 +1,199 @@
+import json
+from shlex import quote as shell_quote
+from subprocess import DEVNULL, PIPE, Popen, check_output
+
+from . import blockdiff
+from .remotepy import module_source, remote_python_arg
+
+
+def blockdiff_local_args(*args):
+    return ('sudo', 'python3', blockdiff.__file__) + tuple(
+        str(i) for i in args)
+
+
+class _VolumeBase:
+    """
+    Non-ZFS source volume on a storage host. Instead of zfs send, it
+    produces "rbd diff v1" streams that blockdiff.py applies to a local
+    zvol.
+
+    If uses_dest_digests is set, the source has no diff of its own, and
+    export_diff() needs the chunk digests of the destination to find the
+    changed blocks. Its stream is then followed by the digests of the
+    source (see blockdiff.py).
+    """
+    uses_dest_digests = False
+    keeps_snapshots = True
+
+    def __init__(self, *, run_remote_args, **kwargs):
+        super().__init__(**kwargs)
+        self._run_remote_args = tuple(run_remote_args)  # ('ssh', 'user@host')
+
+    def remote_exec(self, *args):
+        # Make the call into a single argument: "'sudo' 'rbd' '...'"
+        remote_arg = ' '.join(shell_quote(i) for i in (('sudo',) + args))
+        ret = check_output(self._run_remote_args + (remote_arg,))
+        return ret.decode('utf-8').strip()
+
+    def get_size(self):
+        raise NotImplementedError()
+
+    def get_snapshots_by_date(self):
+        raise NotImplementedError()
+
+    def make_snapshot(self, snapshot_name):
+        raise NotImplementedError()
+
+    def remove_snapshot(self, snapshot_name):
+        raise NotImplementedError()
+
+    def remove_stale_snapshots(self):
+        """
+        Remove snapshots left behind by an interrupted earlier sync, if
+        keeps_snapshots is not set.
+        """
+        pass
+
+    def export_diff(self, snapshot_name, prev_snapshot_name=None,
+                    dest_digests=None):
+        """
+        Start and return a process writing the diff to its stdout.
+        """
+        raise NotImplementedError()
+
+
+class RbdVolume(_VolumeBase):
+    """
+    Ceph RBD image; incrementals through rbd export-diff --from-snap.
+    Needs rbd(8) with access to the cluster on the storage host. For an
+    external cluster, pass its mon_host, user and keyring (as in the
+    PVE storage options).
+    """
+    def __init__(self, *, pool, image, mon_host=None, user=None,
+                 keyring=None, namespace=None, **kwargs):
+        super().__init__(**kwargs)
+        self._pool = pool
+        self._image = image
+        self._cluster_args = ()
+        if mon_host:
+            self._cluster_args += ('--mon-host', mon_host)
+        if user:
+            self._cluster_args += ('--id', user)
+        if keyring:
+            self._cluster_args += ('--keyring', keyring)
+        if namespace:
+            self._cluster_args += ('--namespace', namespace)
+
+    def __repr__(self):
+        return '<rbd:{}/{}>'.format(self._pool, self._image)
+
+    @property
+    def _spec(self):
+        return '{}/{}'.format(self._pool, self._image)
+
+    def rbd_command(self, *args):
+        return ('rbd',) + self._cluster_args + args
+
+    def get_size(self):
+        info = json.loads(self.remote_exec(*self.rbd_command(
+            'info', '--format', 'json', self._spec)))
+        return int(info['size'])
+
+    def get_snapshots_by_date(self):
+        snaps = json.loads(self.remote_exec(*self.rbd_command(
+            'snap', 'ls', '--format', 'json', self._spec)))
+        return [i['name'] for i in sorted(snaps, key=(lambda x: x['id']))]
+
+    def make_snapshot(self, snapshot_name):
+        self.remote_exec(*self.rbd_command(
+            'snap', 'create', '{}@{}'.format(self._spec, snapshot_name)))
+
+    def remove_snapshot(self, snapshot_name):
+        self.remote_exec(*self.rbd_command(
+            'snap', 'rm', '{}@{}'.format(self._spec, snapshot_name)))
+
+    def export_diff(self, snapshot_name, prev_snapshot_name=None,
+                    dest_digests=None):
+        args = ('sudo',) + self.rbd_command('export-diff')
+        if prev_snapshot_name:
+            args += ('--from-snap', prev_snapshot_name)
+        args += ('{}@{}'.format(self._spec, snapshot_name), '-')
+        remote_arg = ' '.join(shell_quote(i) for i in args)
+        return Popen(
+            self._run_remote_args + (remote_arg,),
+            stdin=DEVNULL, stdout=PIPE)
+
+
+class LvmThinVolume(_VolumeBase):
+    """
+    LVM-thin logical volume. Thin snapshots have no diff of their own, so
+    changed blocks are found by comparing chunk digests: the blockdiff.py
+    helper runs remotely through python3 (with sudo) and only sends the
+    chunks that differ from the destination. The snapshot is removed
+    again after the sync; the destination snapshots are the history.
+    """
+    uses_dest_digests = True
+    keeps_snapshots = False
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, *, vgname, lvname, interpreter='sudo python3',
+                 **kwargs):
+        super().__init__(**kwargs)
+        self._vgname = vgname
+        self._lvname = lvname
+        self._interpreter = interpreter
+
+    def __repr__(self):
+        return '<lvmthin:{}/{}>'.format(self._vgname, self._lvname)
+
+    def _snapshot_lvname(self, snapshot_name):
+        # PVE names its own thin snapshots snap_<lv>_<snapshot> and skips
+        # those; a vm-<vmid>-* name would show up as a disk of the guest
+        # (e.g. after qm rescan).
+        return 'snap_{}_planb-{}'.format(self._lvname, snapshot_name)
+
+    def get_size(self):
+        return int(self.remote_exec(
+            'lvs', '--noheadings', '--nosuffix', '--units', 'b',
+            '-o', 'lv_size', '{}/{}'.format(self._vgname, self._lvname)))
+
+    def get_snapshots_by_date(self):
+        return []  # removed after every sync
+
+    def make_snapshot(self, snapshot_name):
+        snap_lv = self._snapshot_lvname(snapshot_name)
+        self.remote_exec(
+            'lvcreate', '-s', '-n', snap_lv,
+            '{}/{}'.format(self._vgname, self._lvname))
+        # Thin snapshots get the activation skip flag; -K overrides it.
+        self.remote_exec(
+            'lvchange', '-ay', '-K', '{}/{}'.format(self._vgname, snap_lv))
+
+    def remove_snapshot(self, snapshot_name):
+        self.remote_exec(
+            'lvremove', '-f', '{}/{}'.format(
+                self._vgname, self._snapshot_lvname(snapshot_name)))
+
+    def remove_stale_snapshots(self):
+        prefix = self._snapshot_lvname('')
+        lvnames = self.remote_exec(
+            'lvs', '--noheadings', '-o', 'lv_name', self._vgname).split()
+        for lvname in lvnames:
+            if lvname.startswith(prefix):
+                self.remove_snapshot(lvname[len(prefix):])
+
+    def export_diff(self, snapshot_name, prev_snapshot_name=None,
+                    dest_digests=None):
+        device = '/dev/{}/{}'.format(
+            self._vgname, self._snapshot_lvname(snapshot_name))
+        source = module_source(blockdiff)
+        remote_arg = remote_python_arg(
+            self._interpreter, source, 'blockdiff', 'diff', device,
+            self.CHUNK_SIZE, snapshot_name)
+        proc = Popen(
+            self._run_remote_args + (remote_arg,), stdin=PIPE, stdout=PIPE)
+        # The helper reads everything before it writes anything.
+        proc.stdin.write(source)
+        proc.stdin.write(dest_digests or blockdiff.U64.pack(0))
+        proc.stdin.close()
+        return proc
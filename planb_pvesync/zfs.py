@@ -1,5 +1,15 @@
+import logging
 from shlex import quote as shell_quote
-from subprocess import CalledProcessError, check_output
+from subprocess import CalledProcessError, PIPE, check_output
+
+from .zfsagent import ZfsAgentError, get_agent, is_agent_command
+
+log = logging.getLogger(__name__)
+
+# run_remote_args of the hosts where the zfsagent failed: those use plain
+# ssh calls for the rest of this run, instead of starting it again for
+# every filesystem.
+_agent_failed_remotes = set()
 
 
 # Setting these may help if you have more CPU than bandwidth:
@@ -9,7 +19,12 @@ QUICK_DEFLATE_BIN, QUICK_INFLATE_BIN = 'cat', 'cat'
 
 
 class ZfsError(CalledProcessError):
-    pass
+    def __str__(self):
+        ret = super().__str__()
+        if self.stderr:
+            stderr = self.stderr.decode('utf-8', 'replace').strip()
+            ret = '{}: {}'.format(ret.rstrip('.'), stderr)
+        return ret
 
 
 class ZfsCommand:
@@ -22,9 +37,11 @@ class ZfsCommand:
         assert self.pre_pipe is None
         assert self.post_pipe is None
         try:
-            ret = check_output(self.args).decode('utf-8').strip()
+            ret = check_output(self.args, stderr=PIPE)
+            ret = ret.decode('utf-8').strip()
         except CalledProcessError as e:
-            raise ZfsError(*e.args) from e
+            raise ZfsError(
+                e.returncode, e.cmd, output=e.output, stderr=e.stderr) from e
         if not ret:
             return None
         return ret
@@ -42,22 +59,44 @@ class _SystemCalls:
     def zfs_command(self, *args):
         raise NotImplementedError()
 
+    def shell_command(self, script):
+        """
+        Return a ZfsCommand running the shell script on the host this
+        filesystem lives on.
+        """
+        raise NotImplementedError()
+
     def zfs_exec(self, *args):
         cmd = self.zfs_command(*args)
         return cmd.exec()
 
+    def zfs_exec_many(self, *cmds):
+        """
+        Run several zfs commands, returning a list of their outputs. Raises
+        ZfsError for the first failing command.
+        """
+        return [self.zfs_command(*args).exec() for args in cmds]
+
 
 class _FilesystemBase(_SystemCalls):
-    def __init__(self, *, zfs_root, **kwargs):
+    def __init__(self, *, zfs_root, deflate_bin=QUICK_DEFLATE_BIN,
+                 inflate_bin=QUICK_INFLATE_BIN, **kwargs):
         super().__init__(**kwargs)
 
         assert not zfs_root.startswith('/'), zfs_root
         assert not zfs_root.endswith('/'), zfs_root
         self._fs_name = zfs_root  # 'tank', or 'tank/enc'
+        # Used when this is the source (deflate) or destination (inflate).
+        self._deflate_bin = deflate_bin
+        self._inflate_bin = inflate_bin
 
     def __repr__(self):
         return '<zfs:{}>'.format(self._fs_name)
 
+    @property
+    def name(self):
+        return self._fs_name
+
     def descend(self, child_name):
         assert not child_name.startswith('/'), child_name
         assert not child_name.endswith('/'), child_name
@@ -74,6 +113,50 @@ class _FilesystemBase(_SystemCalls):
             'zfs', 'create', '-o', 'mountpoint=none', '-p',
             self._fs_name.rsplit('/', 1)[0])
 
+    @property
+    def device_path(self):
+        return '/dev/zvol/{}'.format(self._fs_name)
+
+    def get_volume_size(self):
+        """
+        Return the volsize of this zvol, or None if it does not exist.
+        """
+        try:
+            ret = self.zfs_exec(
+                'zfs', 'get', '-Hp', '-o', 'value', 'volsize', self._fs_name)
+        except ZfsError:
+            return None
+        return int(ret)
+
+    def ensure_volume_size(self, size):
+        """
+        Create a sparse zvol of (at least) size bytes, or grow it.
+        Returns True if it was created (so it is all zeroes).
+        """
+        current_size = self.get_volume_size()
+        if current_size is None:
+            self.ensure_parent_exists()
+            self.zfs_exec(
+                'zfs', 'create', '-s', '-V', str(size), self._fs_name)
+            return True
+        if current_size < size:
+            self.zfs_exec(
+                'zfs', 'set', 'volsize={}'.format(size), self._fs_name)
+        return False
+
+    def destroy(self):
+        """
+        Destroy this filesystem, including its snapshots.
+        """
+        self.zfs_exec('zfs', 'destroy', '-r', self._fs_name)
+
+    def rollback_snapshot(self, snapshot_name, destroy_later=False):
+        # With destroy_later, also roll back past newer snapshots
+        # (destroying them).
+        args = ('zfs', 'rollback') + (('-r',) if destroy_later else ())
+        self.zfs_exec(
+            *args, '{}@{}'.format(self._fs_name, snapshot_name))
+
     def make_snapshot(self, snapshot_name):
         # FIXME: validate snapshot_name for illegal chars..?
         self.zfs_exec(
@@ -94,16 +177,74 @@ class _FilesystemBase(_SystemCalls):
         snaps = [snap[len(snap_prefix):] for snap in snaps]
         return snaps
 
+    def get_snapshot_properties(self, *properties):
+        """
+        Return a list of (snapshot_name, {property: value}) of all
+        snapshots, oldest first. Values are the parsable (-p) strings.
+        """
+        ret = self.zfs_exec(
+            'zfs', 'list', '-d1', '-Hp', '-screation', '-tsnapshot',
+            '-o', ','.join(('name',) + properties), self._fs_name)
+        if not ret:
+            return []
+
+        snap_prefix = '{}@'.format(self._fs_name)
+        snaps = []
+        for line in ret.split('\n'):
+            values = line.split('\t')
+            assert values[0].startswith(snap_prefix), line
+            snaps.append((
+                values[0][len(snap_prefix):],
+                dict(zip(properties, values[1:]))))
+        return snaps
+
+    def get_snapshot_values(self, snapshot_name, *properties):
+        """
+        Return {property: value} (parsable -p strings) of one snapshot.
+        """
+        ret = self.zfs_exec(
+            *self._get_snapshot_values_args(snapshot_name, properties))
+        return self._parse_values(ret)
+
+    def _get_snapshot_values_args(self, snapshot_name, properties):
+        return (
+            'zfs', 'get', '-Hp', '-o', 'property,value',
+            ','.join(properties),
+            '{}@{}'.format(self._fs_name, snapshot_name))
+
+    @staticmethod
+    def _parse_values(ret):
+        return dict(line.split('\t', 1) for line in ret.split('\n'))
+
     def send_snapshot_size(self, snapshot_name, prev_snapshot_name=None):
+        ret = self.zfs_exec(
+            *self._send_snapshot_size_args(snapshot_name, prev_snapshot_name))
+        return self._parse_send_size(ret)
+
+    def send_snapshot_size_and_values(
+            self, snapshot_name, *properties, prev_snapshot_name=None):
+        """
+        Return the send size estimate and the {property: value} of the
+        snapshot, fetched in a single batch.
+        """
+        size_ret, values_ret = self.zfs_exec_many(
+            self._send_snapshot_size_args(snapshot_name, prev_snapshot_name),
+            self._get_snapshot_values_args(snapshot_name, properties))
+        return (
+            self._parse_send_size(size_ret), self._parse_values(values_ret))
+
+    def _send_snapshot_size_args(self, snapshot_name, prev_snapshot_name):
         if prev_snapshot_name:
-            ret = self.zfs_exec(
+            return (
                 'zfs', 'send', '-Pnv', '-i',
                 '{}@{}'.format(self._fs_name, prev_snapshot_name),
                 '{}@{}'.format(self._fs_name, snapshot_name))
-        else:
-            ret = self.zfs_exec(
-                'zfs', 'send', '-Pnv',
-                '{}@{}'.format(self._fs_name, snapshot_name))
+        return (
+            'zfs', 'send', '-Pnv',
+            '{}@{}'.format(self._fs_name, snapshot_name))
+
+    @staticmethod
+    def _parse_send_size(ret):
         try:
             size_line = [
                 i for i in ret.split('\n')
@@ -120,13 +261,72 @@ class _FilesystemBase(_SystemCalls):
                 'zfs', 'send', '-i',
                 '{}@{}'.format(self._fs_name, prev_snapshot_name),
                 '{}@{}'.format(self._fs_name, snapshot_name),
-                post_pipe=QUICK_DEFLATE_BIN)  # e.g. gzip
+                post_pipe=self._deflate_bin)  # e.g. gzip
         return self.zfs_command(
             'zfs', 'send', '{}@{}'.format(self._fs_name, snapshot_name),
-            post_pipe=QUICK_DEFLATE_BIN)  # e.g. gzip
+            post_pipe=self._deflate_bin)  # e.g. gzip
+
+    def get_receive_resume_token(self):
+        """
+        Return the token of an interrupted 'zfs recv -s', or None.
+        """
+        try:
+            ret = self.zfs_exec(
+                'zfs', 'get', '-H', '-o', 'value', 'receive_resume_token',
+                self._fs_name)
+        except ZfsError:
+            return None  # no filesystem, no token
+        if not ret or ret == '-':
+            return None
+        return ret
+
+    def abort_receive(self):
+        """
+        Discard the partial state of an interrupted 'zfs recv -s'.
+        """
+        self.zfs_exec('zfs', 'recv', '-A', self._fs_name)
+
+    def send_resume_size(self, resume_token):
+        ret = self.zfs_exec('zfs', 'send', '-Pnv', '-t', resume_token)
+        return self._parse_send_size(ret)
+
+    def send_resume_command(self, resume_token):
+        return self.zfs_command(
+            'zfs', 'send', '-t', resume_token,
+            post_pipe=self._deflate_bin)  # e.g. gzip
+
+    def send_snapshot_to_file_command(self, snapshot_name, filename):
+        """
+        Full send of snapshot into filename, on the host this filesystem
+        lives on, with its SHA-256 in filename.sha256.
+
+        ZFS send streams only contain allocated blocks, so for sparse
+        (thin) zvols the file is only as large as the written data.
+
+        The exit status of a plain pipe is that of its last command only,
+        so every stage reports its failure on fd 3. The .sha256 file is
+        only put in place if none did.
+        """
+        # FIXME: validate snapshot_name for illegal chars..?
+        sendcmd = ' '.join(shell_quote(i) for i in (
+            'sudo', 'zfs', 'send',
+            '{}@{}'.format(self._fs_name, snapshot_name)))
+        sumfile = shell_quote('{}.sha256'.format(filename))
+        filename = shell_quote(filename)
+        return self.shell_command(
+            'rm -f {sumfile} && failed=$('
+            '{{ {{ {send} || echo send >&3; }} | '
+            '{{ {deflate} || echo deflate >&3; }} | '
+            '{{ tee {file} || echo tee >&3; }} | '
+            '{{ sha256sum > {sumfile}.new || echo sha256sum >&3; }}; '
+            '}} 3>&1 >/dev/null) && test -z "$failed" && '
+            'mv {sumfile}.new {sumfile} || '
+            '{{ echo "seed export failed:" $failed >&2; exit 1; }}'.format(
+                send=sendcmd, deflate=self._deflate_bin, file=filename,
+                sumfile=sumfile))
 
     def recv_command(self, pre_pipe=None):
-        default_pre_pipe = QUICK_INFLATE_BIN  # e.g. zcat
+        default_pre_pipe = self._inflate_bin  # e.g. zcat
         if pre_pipe:
             pre_pipe = '{} | {}'.format(default_pre_pipe, pre_pipe)
         else:
@@ -134,8 +334,10 @@ class _FilesystemBase(_SystemCalls):
 
         # FIXME: add optional '-F' for --force-overwrite to fix problems with
         # source and destination being unequal
+        # Use '-s' so an interrupted receive can be resumed, see
+        # get_receive_resume_token().
         return self.zfs_command(
-            'zfs', 'recv', self._fs_name, pre_pipe=pre_pipe)
+            'zfs', 'recv', '-s', self._fs_name, pre_pipe=pre_pipe)
 
 
 class LocalFilesystem(_FilesystemBase):
@@ -144,11 +346,17 @@ class LocalFilesystem(_FilesystemBase):
         args = ('sudo', 'zfs') + args[1:]
         return ZfsCommand(args, pre_pipe=pre_pipe, post_pipe=post_pipe)
 
+    def shell_command(self, script):
+        return ZfsCommand(('/bin/sh', '-c', script))
+
 
 class RemoteFilesystem(_FilesystemBase):
-    def __init__(self, *, run_remote_args, **kwargs):
+    def __init__(self, *, run_remote_args, agent_command=None, **kwargs):
         super().__init__(**kwargs)
         self._run_remote_args = tuple(run_remote_args)  # ('ssh', 'user@host')
+        # If set, e.g. 'sudo python3': run metadata commands through a
+        # zfsagent on the remote host instead of an ssh call each.
+        self._agent_command = agent_command
 
     def zfs_command(self, *args, pre_pipe=None, post_pipe=None):
         assert args[0] == 'zfs', 'Only supported zfs arg for now'
@@ -163,3 +371,32 @@ class RemoteFilesystem(_FilesystemBase):
         # Prepend remote args: ('ssh', 'user@host', "'zfs' 'list' '...'")
         args = self._run_remote_args + (remote_arg,)
         return ZfsCommand(args, pre_pipe=None, post_pipe=None)
+
+    def shell_command(self, script):
+        return ZfsCommand(self._run_remote_args + (script,))
+
+    def zfs_exec(self, *args):
+        return self.zfs_exec_many(args)[0]
+
+    def zfs_exec_many(self, *cmds):
+        if (not self._agent_command or
+                self._run_remote_args in _agent_failed_remotes or
+                not all(is_agent_command(args) for args in cmds)):
+            return super().zfs_exec_many(*cmds)
+
+        agent = get_agent(self._run_remote_args, self._agent_command)
+        try:
+            results = agent.exec_many(cmds)
+        except ZfsAgentError as e:
+            log.warning('%s; falling back to plain ssh', e)
+            _agent_failed_remotes.add(self._run_remote_args)
+            return super().zfs_exec_many(*cmds)
+
+        ret = []
+        for args, (returncode, out, err) in zip(cmds, results):
+            if returncode:
+                raise ZfsError(
+                    returncode, args, output=out.encode('utf-8'),
+                    stderr=err.encode('utf-8'))
+            ret.append(out.strip() or None)
+        return ret
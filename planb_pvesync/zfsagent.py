@@ -0,0 +1,179 @@
+"""
+Small helper that runs zfs metadata commands on a storage host.
+
+The client starts it once per host (over the same ssh connection
+arguments) by sending the source of this file to a remote python3. After
+that it answers batches of zfs commands over stdin/stdout. Each frame is
+a 4-byte big-endian length followed by that many bytes of UTF-8 JSON:
+
+    agent -> client: {"version": 1}
+    client -> agent: {"cmds": [["zfs", "list", ...], ...]}
+    agent -> client: {"results": [{"rc": 0, "out": "...", "err": ""}, ...]}
+
+Only read-only commands, snapshots and send size estimates are accepted.
+The remote end is started through remotepy.py.
+"""
+import atexit
+import json
+import os
+import struct
+import subprocess
+import sys
+
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('>I')
+
+AGENT_SUBCOMMANDS = ('list', 'get', 'snapshot')
+
+
+class ZfsAgentError(Exception):
+    pass
+
+
+def is_agent_command(args):
+    """
+    Return True if args ('zfs', 'list', ...) may be run by the agent.
+    """
+    if len(args) < 2 or args[0] != 'zfs':
+        return False
+    if args[1] in AGENT_SUBCOMMANDS:
+        return True
+    # Only 'zfs send -n' (dry-run, for the size estimate).
+    return args[1] == 'send' and any(
+        i.startswith('-') and not i.startswith('--') and 'n' in i
+        for i in args[2:])
+
+
+def read_frame(fp):
+    header = fp.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) != FRAME_HEADER.size:
+        raise ZfsAgentError('short frame header')
+    length, = FRAME_HEADER.unpack(header)
+    data = fp.read(length)
+    if len(data) != length:
+        raise ZfsAgentError('short frame')
+    return json.loads(data.decode('utf-8'))
+
+
+def write_frame(fp, obj):
+    data = json.dumps(obj).encode('utf-8')
+    fp.write(FRAME_HEADER.pack(len(data)) + data)
+    fp.flush()
+
+
+def serve(infp, outfp):
+    if os.geteuid() == 0:
+        prefix = []
+    else:
+        prefix = ['sudo', '-n']
+
+    write_frame(outfp, {'version': PROTOCOL_VERSION})
+    while True:
+        request = read_frame(infp)
+        if request is None:
+            break
+        results = []
+        for args in request['cmds']:
+            if not is_agent_command(args):
+                results.append({
+                    'rc': 1, 'out': '',
+                    'err': 'zfsagent: refusing {!r}'.format(args)})
+                continue
+            proc = subprocess.Popen(
+                prefix + list(args),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+            results.append({
+                'rc': proc.returncode,
+                'out': out.decode('utf-8', 'replace'),
+                'err': err.decode('utf-8', 'replace')})
+        write_frame(outfp, {'results': results})
+
+
+class ZfsAgent:
+    """
+    Client end: start the agent on the host reached through
+    run_remote_args, using the (remote) interpreter command, e.g.
+    'sudo python3' or 'python3'.
+    """
+    def __init__(self, run_remote_args, interpreter):
+        self._run_remote_args = tuple(run_remote_args)
+        self._interpreter = interpreter
+        self._proc = None
+
+    def __repr__(self):
+        return '<zfsagent:{}>'.format(' '.join(self._run_remote_args))
+
+    def start(self):
+        # Imported here, as only the client end runs in the package.
+        from .remotepy import module_source, remote_python_arg
+
+        source = module_source(sys.modules[__name__])
+        remote_arg = remote_python_arg(self._interpreter, source, 'zfsagent')
+        self._proc = subprocess.Popen(
+            self._run_remote_args + (remote_arg,),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self._proc.stdin.write(source)
+            self._proc.stdin.flush()
+            hello = read_frame(self._proc.stdout)
+        except (OSError, ValueError, ZfsAgentError) as e:
+            self.close()
+            raise ZfsAgentError('{!r}: failed to start: {}'.format(
+                self, e)) from e
+        if not hello or hello.get('version') != PROTOCOL_VERSION:
+            self.close()
+            raise ZfsAgentError('{!r}: unexpected hello {!r}'.format(
+                self, hello))
+
+    def exec_many(self, cmds):
+        """
+        Run a batch of zfs commands in one round trip; returns a list of
+        (returncode, stdout, stderr) tuples.
+        """
+        if not self._proc:
+            self.start()
+        try:
+            write_frame(self._proc.stdin, {'cmds': [list(i) for i in cmds]})
+            response = read_frame(self._proc.stdout)
+        except (OSError, ValueError) as e:
+            self.close()
+            raise ZfsAgentError('{!r}: {}'.format(self, e)) from e
+        if response is None:
+            self.close()
+            raise ZfsAgentError('{!r}: agent went away'.format(self))
+        return [(i['rc'], i['out'], i['err']) for i in response['results']]
+
+    def close(self):
+        if self._proc:
+            proc, self._proc = self._proc, None
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            proc.wait()
+
+
+_agents = {}
+
+
+def get_agent(run_remote_args, interpreter):
+    """
+    Return a shared (lazily started) agent per host and interpreter.
+    """
+    key = (tuple(run_remote_args), interpreter)
+    if key not in _agents:
+        _agents[key] = ZfsAgent(run_remote_args, interpreter)
+    return _agents[key]
+
+
+@atexit.register
+def _close_agents():
+    for agent in _agents.values():
+        agent.close()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin.buffer, sys.stdout.buffer)